@@ -1,13 +1,24 @@
-import base64
+import asyncio
+import binascii
 import datetime
+import hashlib
 import html
+import importlib.util
 import io
+import logging
 import os
+import random
+import secrets
+import string
+import threading
 import uuid
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
 
 import json
-from PIL import Image
+from cachetools import TTLCache
+from PIL import Image, ImageOps
 
 import streamlit as st
 import streamlit.components.v1 as components
@@ -18,17 +29,29 @@ except ImportError:
     StreamlitSecretNotFoundError = Exception
 
 try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    def get_script_run_ctx() -> None:
+        return None
+
+    def add_script_run_ctx(thread: Optional[threading.Thread] = None, ctx: object = None) -> Optional[threading.Thread]:
+        return thread
+
+try:
+    import httpx
     from google import genai
     from google.api_core import exceptions as google_exceptions
+    from google.genai import errors as genai_errors
     from google.genai import types
-    from google.cloud import storage
-    from google.oauth2 import service_account
 except ImportError:
     st.error(
         "必要なライブラリが不足しています。`pip install -r requirements.txt` を実行してください。"
     )
     st.stop()
 
+LOGGER = logging.getLogger(__name__)
+
+
 def get_secret_value(key: str) -> Optional[str]:
     try:
         secrets_obj = st.secrets
@@ -49,20 +72,11 @@ def get_secret_value(key: str) -> Optional[str]:
     return None
 
 
-def rerun_app() -> None:
-    rerun = getattr(st, "rerun", None)
-    if callable(rerun):
-        rerun()
-        return
-    experimental_rerun = getattr(st, "experimental_rerun", None)
-    if callable(experimental_rerun):
-        experimental_rerun()
-
-
 TITLE = "Gemini 画像生成"
 MODEL_NAME = "models/gemini-3-pro-image-preview"
 IMAGE_ASPECT_RATIO = "16:9"
 IMAGE_ASPECT_RATIO_OPTIONS = ("16:9", "9:16", "1:1")
+IMAGE_RESOLUTION_OPTIONS = ("1K", "2K", "4K")
 DEFAULT_PROMPT_SUFFIX = (
     "((masterpiece, best quality, ultra-detailed, photorealistic, 8k, sharp focus))"
 )
@@ -70,13 +84,77 @@ NO_TEXT_TOGGLE_SUFFIX = (
     "((no background text, no symbols, no markings, no letters anywhere, no typography, "
     "no signboard, no watermark, no logo, no text, no subtitles, no labels, no poster elements, neutral background))"
 )
-
-DEFAULT_GEMINI_API_KEY = (
-    get_secret_value("GEMINI_API_KEY")
-    or os.getenv("GOOGLE_API_KEY")
-    or os.getenv("GEMINI_API_KEY")
-    or ""
+PROMPT_TAIL = "\n" + DEFAULT_PROMPT_SUFFIX + "\n" + NO_TEXT_TOGGLE_SUFFIX
+GENERATION_CONCURRENCY = 10
+GENERATION_MAX_ATTEMPTS = 5
+GENERATION_BACKOFF_CAP_SECONDS = 30.0
+# High-resolution images can take well over a minute before the first chunk arrives.
+GENERATION_TIMEOUT_MS = 120_000
+GENERATION_HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+# HTTP/2 lets concurrent variants share one connection, but httpx needs the optional h2 package.
+GENERATION_HTTP2 = importlib.util.find_spec("h2") is not None
+TRANSIENT_API_STATUS_CODES = frozenset({429, 500, 503, 504})
+TRANSIENT_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    httpx.TransportError,
+)
+BASE64_TEXT_BYTES = (string.ascii_letters + string.digits + "+/=\n\r").encode("ascii")
+RESPONSE_CHILD_KEYS = (
+    "candidates",
+    "content",
+    "parts",
+    "generated_content",
+    "contents",
+    "responses",
+    "messages",
+    "media",
+    "image",
+    "images",
 )
+# Dicts can also be raw REST payloads (camelCase keys) or nest the payload in a data/blob container.
+RESPONSE_DICT_CHILD_KEYS = RESPONSE_CHILD_KEYS + (
+    "inline_data",
+    "file_data",
+    "data",
+    "blob",
+    "inlineData",
+    "fileData",
+    "generatedContent",
+)
+IMAGE_FORMAT_EXTENSIONS: Dict[str, Tuple[str, str]] = {
+    "PNG": ("png", "image/png"),
+    "JPEG": ("jpg", "image/jpeg"),
+    "JPG": ("jpg", "image/jpeg"),
+    "WEBP": ("webp", "image/webp"),
+}
+MAX_VARIANTS = 8
+GENERATION_CACHE_TTL_SECONDS = 3600
+GENERATION_CACHE_MAX_ENTRIES = 128
+MAX_HISTORY_ENTRIES = 20
+GCS_UPLOAD_MAX_WORKERS = 4
+UPLOAD_STATUS_REFRESH_SECONDS = 2
+GCS_WEBP_QUALITY = 92
+GCS_SIGNED_URL_TTL = datetime.timedelta(hours=1)
+GCS_SIGNED_URL_REFRESH_MARGIN = datetime.timedelta(seconds=60)
+HISTORY_THUMBNAIL_EDGE = 512
+HISTORY_THUMBNAIL_QUALITY = 80
+REFERENCE_MAX_EDGE = 1568
+REFERENCE_JPEG_QUALITY = 88
+REFERENCE_PASSTHROUGH_BYTES = 512 * 1024
+REFERENCE_PREP_MAX_WORKERS = 8
+# Checked against the prepared bytes. A downscaled JPEG stays far below this, so only
+# files Pillow could not decode (and were passed through unchanged) can exceed it.
+INLINE_REFERENCE_LIMIT_BYTES = 4 * 1024 * 1024
+# Files API uploads expire after 48 hours; keep the cached URIs a little shorter.
+REFERENCE_FILE_URI_TTL_SECONDS = 47 * 60 * 60
+REFERENCE_UPLOAD_MAX_ENTRIES = 64
+REFERENCE_UPLOAD_MAX_WORKERS = 2
+# Older google-genai releases have no ImageConfig.image_size; check the schema once at import.
+_IMAGE_CONFIG_FIELDS = getattr(types.ImageConfig, "model_fields", None) or getattr(types.ImageConfig, "__fields__", {})
+IMAGE_SIZE_CONFIG_KEY: Optional[str] = "image_size" if "image_size" in _IMAGE_CONFIG_FIELDS else None
 
 
 def _is_truthy(value: Optional[object]) -> bool:
@@ -92,10 +170,7 @@ def _is_truthy(value: Optional[object]) -> bool:
 
 
 def is_gcs_upload_enabled() -> bool:
-    raw = get_secret_value("ENABLE_GCS_UPLOAD")
-    if raw is None:
-        raw = os.getenv("ENABLE_GCS_UPLOAD")
-    return _is_truthy(raw)
+    return bool(_resolved_secrets()["gcs_upload_enabled"])
 
 
 def _normalize_credential(value: Optional[str]) -> Optional[str]:
@@ -114,41 +189,16 @@ def get_secret_auth_credentials() -> Tuple[Optional[str], Optional[str]]:
     except Exception:
         return None, None
 
-    auth_section: Optional[Dict[str, Any]] = None
-    if isinstance(secrets_obj, dict):
-        auth_section = secrets_obj.get("auth")
-    else:
-        auth_section = getattr(secrets_obj, "get", lambda _key, _default=None: None)("auth")
-
-    def _get_from_container(container: object, key: str) -> Optional[Any]:
-        if isinstance(container, dict):
-            return container.get(key)
-        getter = getattr(container, "get", None)
-        if callable(getter):
-            try:
-                return getter(key)
-            except TypeError:
-                try:
-                    return getter(key, None)
-                except TypeError:
-                    return None
-        try:
-            return getattr(container, key)
-        except AttributeError:
-            return None
-
-    def _extract_credential(container: object, keys: Tuple[str, ...]) -> Optional[Any]:
-        for key in keys:
-            value = _get_from_container(container, key)
-            if value is not None:
-                return value
-        return None
+    try:
+        auth_section = _get_from_container(secrets_obj, "auth")
+    except StreamlitSecretNotFoundError:
+        auth_section = None
 
     username = None
     password = None
     if auth_section is not None:
-        username = _extract_credential(auth_section, ("username", "id", "user", "name"))
-        password = _extract_credential(auth_section, ("password", "pass", "pwd"))
+        username = _first_present(auth_section, ("username", "id", "user", "name"))
+        password = _first_present(auth_section, ("password", "pass", "pwd"))
 
     if username is None:
         username = get_secret_value("USERNAME") or get_secret_value("ID")
@@ -160,10 +210,32 @@ def get_secret_auth_credentials() -> Tuple[Optional[str], Optional[str]]:
     return normalized_username, normalized_password
 
 
+@st.cache_resource(show_spinner=False)
+def _resolved_secrets() -> Dict[str, object]:
+    # st.secrets and the environment do not change while the process runs; resolve them once.
+    username, password = get_secret_auth_credentials()
+    gcs_upload_flag = get_secret_value("ENABLE_GCS_UPLOAD")
+    if gcs_upload_flag is None:
+        gcs_upload_flag = os.getenv("ENABLE_GCS_UPLOAD")
+    return {
+        "api_key": (
+            get_secret_value("GEMINI_API_KEY")
+            or os.getenv("GOOGLE_API_KEY")
+            or os.getenv("GEMINI_API_KEY")
+            or ""
+        ),
+        "username": username,
+        "password": password,
+        "gcs_upload_enabled": _is_truthy(gcs_upload_flag),
+    }
+
+
 def get_configured_auth_credentials() -> Tuple[str, str]:
-    secret_username, secret_password = get_secret_auth_credentials()
+    secrets_map = _resolved_secrets()
+    secret_username = secrets_map["username"]
+    secret_password = secrets_map["password"]
     if secret_username and secret_password:
-        return secret_username, secret_password
+        return str(secret_username), str(secret_password)
     return "mezamashi", "mezamashi"
 
 
@@ -174,24 +246,27 @@ def require_login() -> None:
     if st.session_state["authenticated"]:
         return
 
-    st.title("ログイン")
+    login_area = st.empty()
+    with login_area.container():
+        st.title("ログイン")
 
-    username, password = get_configured_auth_credentials()
-    if not username or not password:
-        st.info("ログイン情報が未設定です。管理者に連絡してください。")
-        st.stop()
-        return
+        username, password = get_configured_auth_credentials()
+        if not username or not password:
+            st.info("ログイン情報が未設定です。管理者に連絡してください。")
+            st.stop()
+            return
 
-    with st.form("login_form", clear_on_submit=False):
-        input_username = st.text_input("ID")
-        input_password = st.text_input("PASS", type="password")
-        submitted = st.form_submit_button("ログイン")
+        with st.form("login_form", clear_on_submit=False):
+            input_username = st.text_input("ID")
+            input_password = st.text_input("PASS", type="password")
+            submitted = st.form_submit_button("ログイン")
 
     if submitted:
         if input_username == username and input_password == password:
+            # Continue into the app in this run instead of forcing a second full rerun.
             st.session_state["authenticated"] = True
-            st.success("ログインしました。")
-            rerun_app()
+            login_area.empty()
+            st.toast("ログインしました。")
             return
         st.error("IDまたはPASSが正しくありません。")
     st.stop()
@@ -201,7 +276,8 @@ def get_current_api_key() -> Optional[str]:
     api_key = st.session_state.get("config_api_key")
     if isinstance(api_key, str) and api_key.strip():
         return api_key.strip()
-    return DEFAULT_GEMINI_API_KEY
+    default_api_key = _resolved_secrets()["api_key"]
+    return str(default_api_key) if default_api_key else None
 
 
 def load_configured_api_key() -> str:
@@ -215,7 +291,7 @@ def decode_image_data(data: Optional[object]) -> Optional[bytes]:
         return data
     if isinstance(data, str):
         try:
-            return base64.b64decode(data)
+            return binascii.a2b_base64(data)
         except (ValueError, TypeError):
             return None
     return None
@@ -243,7 +319,43 @@ def _load_uploaded_file(upload) -> Tuple[Optional[bytes], Optional[str]]:
     return data if data else None, mime_type
 
 
-def _load_uploaded_files(uploads: Optional[object]) -> List[Tuple[bytes, Optional[str]]]:
+def _downscale_reference_image(data: bytes, mime_type: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    if len(data) <= REFERENCE_PASSTHROUGH_BYTES:
+        # Already small; re-encoding would cost CPU and quality for little saving.
+        return data, mime_type
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((REFERENCE_MAX_EDGE, REFERENCE_MAX_EDGE), Image.LANCZOS)
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, format="JPEG", quality=REFERENCE_JPEG_QUALITY, optimize=True)
+    except Exception:
+        return data, mime_type
+    return buf.getvalue(), "image/jpeg"
+
+
+@st.cache_data(show_spinner=False)
+def prepare_reference_image(data: bytes, mime_type: Optional[str]) -> Tuple[bytes, Optional[str], str]:
+    prepared, prepared_mime = _downscale_reference_image(data, mime_type)
+    # The content digest keys the generation cache and Files API URIs; computing it here means
+    # repeat generations with the same references get it from the cache instead of rehashing.
+    return prepared, prepared_mime, hashlib.blake2b(prepared, digest_size=16).hexdigest()
+
+
+def prepare_reference_images(files: List[Tuple[bytes, Optional[str]]]) -> List[Tuple[bytes, Optional[str], str]]:
+    if len(files) <= 1:
+        return [prepare_reference_image(data, mime) for data, mime in files]
+    # Pillow releases the GIL while decoding and encoding, so references resize in parallel.
+    # Workers share the script context so the st.cache_data lookups behave as on the main thread.
+    with ThreadPoolExecutor(
+        max_workers=min(REFERENCE_PREP_MAX_WORKERS, len(files)),
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    ) as executor:
+        return list(executor.map(lambda item: prepare_reference_image(*item), files))
+
+
+def prepare_uploaded_references(uploads: Optional[object]) -> List[Tuple[bytes, Optional[str], str]]:
     if uploads is None:
         return []
 
@@ -252,12 +364,37 @@ def _load_uploaded_files(uploads: Optional[object]) -> List[Tuple[bytes, Optiona
     else:
         candidates = [uploads]
 
-    files: List[Tuple[bytes, Optional[str]]] = []
-    for upload in candidates:
-        data, mime = _load_uploaded_file(upload)
-        if data:
-            files.append((data, mime))
-    return files
+    # Keyed by the uploader's file id, so resubmitting with the same files skips reading,
+    # hashing and resizing them again.
+    cached: Dict[Tuple[object, object], Tuple[bytes, Optional[str], str]] = st.session_state.get(
+        "prepared_references", {}
+    )
+    keys = [(getattr(upload, "file_id", None), getattr(upload, "size", None)) for upload in candidates]
+    loaded: List[Tuple[int, bytes, Optional[str]]] = []
+    for position, (key, upload) in enumerate(zip(keys, candidates)):
+        if key[0] is None or key not in cached:
+            data, mime = _load_uploaded_file(upload)
+            if data:
+                loaded.append((position, data, mime))
+
+    prepared = dict(
+        zip(
+            (position for position, _, _ in loaded),
+            prepare_reference_images([(data, mime) for _, data, mime in loaded]),
+        )
+    )
+    results: List[Tuple[bytes, Optional[str], str]] = []
+    current: Dict[Tuple[object, object], Tuple[bytes, Optional[str], str]] = {}
+    for position, key in enumerate(keys):
+        item = prepared.get(position) or cached.get(key)
+        if item is None:
+            continue
+        results.append(item)
+        if key[0] is not None:
+            current[key] = item
+    # Only the current uploads are kept, so removed files do not linger in session memory.
+    st.session_state.prepared_references = current
+    return results
 
 
 def extract_parts(candidate: object) -> Sequence:
@@ -268,9 +405,22 @@ def extract_parts(candidate: object) -> Sequence:
     return parts or []
 
 
+def extract_inline_image_bytes(response: object) -> Optional[bytes]:
+    # google-genai responses always carry images at candidates[*].content.parts[*].inline_data.
+    for candidate in getattr(response, "candidates", None) or ():
+        content = getattr(candidate, "content", None)
+        for part in getattr(content, "parts", None) or ():
+            inline_data = getattr(part, "inline_data", None)
+            if inline_data is not None:
+                decoded = decode_image_data(getattr(inline_data, "data", None))
+                if decoded:
+                    return decoded
+    return None
+
+
 def collect_image_bytes(response: object) -> Optional[bytes]:
     visited: set[int] = set()
-    queue: List[object] = []
+    queue: Deque[object] = deque()
 
     if response is not None:
         queue.append(response)
@@ -298,10 +448,8 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
                 return decoded
         return None
 
-    base64_charset = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\n\r")
-
     while queue:
-        current = queue.pop(0)
+        current = queue.popleft()
         if current is None:
             continue
 
@@ -318,7 +466,12 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
 
         if isinstance(current, str):
             candidate = current.strip()
-            if len(candidate) > 80 and set(candidate) <= base64_charset:
+            # Only pure base64 text is left empty once the base64 alphabet is deleted.
+            if (
+                len(candidate) > 80
+                and candidate.isascii()
+                and not candidate.encode("ascii").translate(None, BASE64_TEXT_BYTES)
+            ):
                 decoded = decode_image_data(candidate)
                 if decoded:
                     return decoded
@@ -339,12 +492,15 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
             if decoded:
                 return decoded
 
-            for key, value in current.items():
-                if key in {"data", "image", "blob"}:
-                    decoded = decode_image_data(value)
-                    if decoded:
-                        return decoded
-                queue.append(value)
+            for key in ("data", "image", "blob"):
+                decoded = decode_image_data(current.get(key))
+                if decoded:
+                    return decoded
+            # Only walk keys that can lead to image data rather than every value in the dict.
+            for key in RESPONSE_DICT_CHILD_KEYS:
+                value = current.get(key)
+                if value is not None:
+                    queue.append(value)
             continue
 
         decoded = handle_inline(getattr(current, "inline_data", None))
@@ -355,24 +511,13 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
         if decoded:
             return decoded
 
-        for attr in (
-            "candidates",
-            "content",
-            "parts",
-            "generated_content",
-            "contents",
-            "responses",
-            "messages",
-            "media",
-            "image",
-            "images",
-        ):
+        for attr in RESPONSE_CHILD_KEYS:
             value = getattr(current, attr, None)
             if value is not None:
                 queue.append(value)
 
         if isinstance(current, Sequence) and not isinstance(current, (str, bytes, bytearray, memoryview)):
-            queue.extend(list(current))
+            queue.extend(current)
 
     return None
 
@@ -386,26 +531,23 @@ def detect_image_format(image_bytes: Optional[bytes]) -> Tuple[str, str]:
             fmt = (img.format or "").upper()
     except Exception:
         return default
-    mapping = {
-        "PNG": ("png", "image/png"),
-        "JPEG": ("jpg", "image/jpeg"),
-        "JPG": ("jpg", "image/jpeg"),
-        "WEBP": ("webp", "image/webp"),
-    }
-    return mapping.get(fmt, default)
+    return IMAGE_FORMAT_EXTENSIONS.get(fmt, default)
+
+
+def _part_text(part: object) -> Optional[str]:
+    if isinstance(part, dict):
+        return part.get("text")
+    return getattr(part, "text", None)
 
 
 def collect_text_parts(response: object) -> List[str]:
-    texts: List[str] = []
-    candidates = getattr(response, "candidates", None) or []
-    for candidate in candidates:
-        for part in extract_parts(candidate):
-            text = getattr(part, "text", None)
-            if text is None and isinstance(part, dict):
-                text = part.get("text")
-            if text:
-                texts.append(text)
-    return texts
+    return [
+        text
+        for candidate in getattr(response, "candidates", None) or ()
+        for part in extract_parts(candidate)
+        for text in (_part_text(part),)
+        if text
+    ]
 
 
 def _get_from_container(container: object, key: str) -> Optional[Any]:
@@ -428,22 +570,29 @@ def _get_from_container(container: object, key: str) -> Optional[Any]:
         return None
 
 
+def _first_present(container: object, keys: Tuple[str, ...]) -> Optional[Any]:
+    for key in keys:
+        value = _get_from_container(container, key)
+        if value is not None:
+            return value
+    return None
+
+
+def _build_filename_translation() -> Dict[int, Optional[str]]:
+    # U+3000 is the highest code point for which str.isspace() is true.
+    table: Dict[int, Optional[str]] = {code: "_" for code in range(0x3001) if chr(code).isspace()}
+    table.update({code: None for code in range(32)})
+    table.update({ord(char): None for char in '\\/:*?"<>|'})
+    table.update({ord("\n"): "-n-", ord("\r"): "-n-"})
+    return table
+
+
+FILENAME_TRANSLATION = _build_filename_translation()
+
+
 def sanitize_filename_component(value: str, max_length: int = 80) -> str:
     text = value or ""
-    sanitized_chars: List[str] = []
-    for char in text:
-        if char in {"\n", "\r"}:
-            sanitized_chars.append("-n-")
-            continue
-        if ord(char) < 32:
-            continue
-        if char in {'\\', '/', ':', '*', '?', '"', '<', '>', '|'}:
-            continue
-        if char.isspace():
-            sanitized_chars.append("_")
-            continue
-        sanitized_chars.append(char)
-    sanitized = "".join(sanitized_chars).strip("_")
+    sanitized = text.translate(FILENAME_TRANSLATION).strip("_")
     if not sanitized:
         sanitized = "prompt"
     if len(sanitized) > max_length:
@@ -458,39 +607,67 @@ def build_prompt_based_filename(prompt_text: str, extension: str = "png") -> str
     return f"user06_{prompt_component}_{unique_suffix}.{cleaned_ext}"
 
 
-def upload_image_to_gcs(
-    image_bytes: bytes,
-    filename_prefix: str = "gemini_image",
-    object_name: Optional[str] = None,
-    mime_type: str = "image/png",
-    extension: str = "png",
-) -> Tuple[Optional[str], Optional[str]]:
-    normalized_ext = (extension or "").lower().lstrip(".") or "png"
-    normalized_mime = mime_type or "image/png"
-    if not is_gcs_upload_enabled():
-        st.info("GCS へのアップロードは無効化されています。")
-        return None, None
-    if not image_bytes:
-        return None, None
+@st.cache_data(show_spinner=False)
+def parse_service_account_json(raw_json: str) -> Any:
+    try:
+        return json.loads(raw_json)
+    except json.JSONDecodeError:
+        return json.loads(raw_json, strict=False)
+
+
+@st.cache_resource(show_spinner=False)
+def get_storage_client(service_account_info: Dict[str, Any], project_id: Optional[str]) -> Any:
+    # Imported lazily: google-cloud-storage is only needed once an upload actually happens.
+    from google.cloud import storage
+
+    return storage.Client.from_service_account_info(service_account_info, project=project_id)
 
+
+@st.cache_resource(show_spinner=False)
+def _gcs_upload_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=GCS_UPLOAD_MAX_WORKERS, thread_name_prefix="gcs-upload")
+
+
+def _sign_blob_url(blob: Any) -> Tuple[str, datetime.datetime]:
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + GCS_SIGNED_URL_TTL
+    signed_url = blob.generate_signed_url(version="v4", expiration=expires_at, method="GET")
+    return signed_url, expires_at
+
+
+def _encode_webp(image_bytes: bytes) -> bytes:
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        if img.format == "WEBP":
+            return image_bytes
+        buf = io.BytesIO()
+        img.save(buf, format="WEBP", quality=GCS_WEBP_QUALITY, method=6)
+    return buf.getvalue()
+
+
+def _upload_blob(
+    bucket: Any, filename: str, image_bytes: bytes, mime_type: str
+) -> Tuple[str, str, datetime.datetime]:
+    if mime_type == "image/webp":
+        image_bytes = _encode_webp(image_bytes)
+    blob = bucket.blob(filename)
+    blob.upload_from_string(image_bytes, content_type=mime_type)
+    signed_url, expires_at = _sign_blob_url(blob)
+    return f"gs://{bucket.name}/{filename}", signed_url, expires_at
+
+
+def get_gcs_bucket() -> Optional[Any]:
     try:
         secrets_obj = st.secrets
     except StreamlitSecretNotFoundError:
         st.warning("GCPの設定が見つからないためアップロードをスキップしました。")
-        return None, None
+        return None
     except Exception as exc:  # noqa: BLE001
         st.error(f"GCPの設定取得時にエラーが発生しました: {exc}")
-        return None, None
-
-    gcp_section = None
-    if isinstance(secrets_obj, dict):
-        gcp_section = secrets_obj.get("gcp")
-    else:
-        gcp_section = _get_from_container(secrets_obj, "gcp")
+        return None
 
+    gcp_section = _get_from_container(secrets_obj, "gcp")
     if not gcp_section:
         st.warning("GCPの設定が見つからないためアップロードをスキップしました。")
-        return None, None
+        return None
 
     bucket_name = _get_from_container(gcp_section, "bucket_name")
     service_account_json = _get_from_container(gcp_section, "service_account_json")
@@ -498,36 +675,54 @@ def upload_image_to_gcs(
 
     if not bucket_name or not service_account_json:
         st.warning("GCPの設定のうち bucket_name または service_account_json が不足しています。")
-        return None, None
+        return None
 
     service_account_info: Optional[Dict[str, Any]] = None
     if isinstance(service_account_json, (dict,)):
         service_account_info = dict(service_account_json)
     elif isinstance(service_account_json, (str, bytes)):
         raw_json = service_account_json.decode("utf-8") if isinstance(service_account_json, bytes) else service_account_json
-        raw_json = raw_json.strip()
         try:
-            service_account_info = json.loads(raw_json)
-        except json.JSONDecodeError:
-            try:
-                service_account_info = json.loads(raw_json, strict=False)
-            except json.JSONDecodeError as exc:
-                st.error(f"service_account_json の読み込みに失敗しました: {exc}")
-                return None, None
+            service_account_info = parse_service_account_json(raw_json.strip())
+        except json.JSONDecodeError as exc:
+            st.error(f"service_account_json の読み込みに失敗しました: {exc}")
+            return None
     else:
         st.error("service_account_json の形式が不明です。文字列または辞書で設定してください。")
-        return None, None
+        return None
 
     if not isinstance(service_account_info, dict):
         st.error("service_account_json の内容が辞書形式ではありません。")
-        return None, None
+        return None
+
+    try:
+        storage_client = get_storage_client(service_account_info, str(project_id) if project_id else None)
+        return storage_client.bucket(str(bucket_name))
+    except Exception as exc:  # noqa: BLE001
+        st.error(f"GCSクライアントの初期化に失敗しました: {exc}")
+        return None
+
+
+def upload_image_to_gcs(
+    image_bytes: bytes,
+    filename_prefix: str = "gemini_image",
+    object_name: Optional[str] = None,
+    mime_type: str = "image/png",
+    extension: str = "png",
+) -> Optional["Future[Tuple[str, str, datetime.datetime]]"]:
+    normalized_ext = (extension or "").lower().lstrip(".") or "png"
+    normalized_mime = mime_type or "image/png"
+    if not is_gcs_upload_enabled():
+        st.info("GCS へのアップロードは無効化されています。")
+        return None
+    if not image_bytes:
+        return None
+
+    bucket = get_gcs_bucket()
+    if bucket is None:
+        return None
 
     try:
-        storage_client = storage.Client.from_service_account_info(
-            service_account_info,
-            project=str(project_id) if project_id else None,
-        )
-        bucket = storage_client.bucket(str(bucket_name))
         if object_name:
             cleaned_object_name = object_name.strip()
             if not cleaned_object_name.lower().endswith(f".{normalized_ext}"):
@@ -537,394 +732,675 @@ def upload_image_to_gcs(
         else:
             timestamp = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
             filename = f"images/{filename_prefix}_{timestamp}_{uuid.uuid4().hex}.{normalized_ext}"
-        blob = bucket.blob(filename)
-        blob.upload_from_file(io.BytesIO(image_bytes), content_type=normalized_mime)
-
-        gcs_path = f"gs://{bucket.name}/{filename}"
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=datetime.timedelta(hours=1),
-            method="GET",
-        )
-        return gcs_path, signed_url
+        # Upload and URL signing run in the background so the rerun does not wait on the PUT.
+        return _gcs_upload_executor().submit(_upload_blob, bucket, filename, image_bytes, normalized_mime)
     except Exception as exc:  # noqa: BLE001
         st.error(f"GCSへのアップロードに失敗しました: {exc}")
-        return None, None
+        return None
+
+
+def _upload_result(entry: Dict[str, object]) -> Optional[Tuple[str, str, datetime.datetime]]:
+    upload_future = entry.get("upload_future")
+    if not isinstance(upload_future, Future) or not upload_future.done() or upload_future.exception() is not None:
+        return None
+    return upload_future.result()
+
+
+def get_signed_url(entry: Dict[str, object]) -> Optional[str]:
+    upload_result = _upload_result(entry)
+    if upload_result is None:
+        return None
+    gcs_path, signed_url, expires_at = upload_result
+    signed_url = entry.get("signed_url", signed_url)
+    expires_at = entry.get("signed_url_expires_at", expires_at)
+    # Signing is an RSA operation, so the URL is reused until shortly before it expires.
+    if datetime.datetime.now(datetime.timezone.utc) < expires_at - GCS_SIGNED_URL_REFRESH_MARGIN:
+        return signed_url
+    bucket = get_gcs_bucket()
+    if bucket is None:
+        return None
+    object_name = str(gcs_path).split("/", 3)[3]
+    signed_url, expires_at = _sign_blob_url(bucket.blob(object_name))
+    entry["signed_url"] = signed_url
+    entry["signed_url_expires_at"] = expires_at
+    return signed_url
 
 
 def init_history() -> None:
-    if "history" not in st.session_state:
-        st.session_state.history: List[Dict[str, object]] = []
+    history = st.session_state.get("history")
+    if not isinstance(history, deque):
+        st.session_state.history: Deque[Dict[str, object]] = deque(history or (), maxlen=MAX_HISTORY_ENTRIES)
 
 
-def ensure_lightbox_assets() -> None:
-    components.html(
-        """
-        <script>
-        (function () {
-            const parentWindow = window.parent;
-            if (!parentWindow) {
-                return;
-            }
+def make_history_thumbnail(image_bytes: bytes) -> Optional[bytes]:
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.thumbnail((HISTORY_THUMBNAIL_EDGE, HISTORY_THUMBNAIL_EDGE))
+            buf = io.BytesIO()
+            img.save(buf, format="WEBP", quality=HISTORY_THUMBNAIL_QUALITY)
+    except Exception:
+        return None
+    return buf.getvalue()
 
-            try {
-                delete parentWindow.__streamlitLightbox;
-            } catch (err) {
-                parentWindow.__streamlitLightbox = undefined;
-            }
-            parentWindow.__streamlitLightboxInitialized = false;
-            const doc = parentWindow.document;
-
-            if (!doc.getElementById("streamlit-lightbox-style")) {
-                const style = doc.createElement("style");
-                style.id = "streamlit-lightbox-style";
-                style.textContent = `
-                .streamlit-lightbox-thumb {
-                    width: 100%;
-                    display: block;
-                    border-radius: 12px;
-                    cursor: pointer;
-                    transition: transform 0.16s ease-in-out;
-                    box-shadow: 0 4px 14px rgba(0, 0, 0, 0.12);
-                    margin: 0 auto 0.75rem auto;
-                }
-                .streamlit-lightbox-thumb:hover {
-                    transform: scale(1.02);
-                }
-                `;
-                doc.head.appendChild(style);
-            }
 
-            parentWindow.__streamlitLightbox = (function () {
-                let overlay = null;
-                let keyHandler = null;
-
-                function hide() {
-                    if (!overlay) {
-                        return;
-                    }
-                    overlay.style.opacity = "0";
-                    const originalOverflow = overlay.getAttribute("data-original-overflow") || "";
-                    doc.body.style.overflow = originalOverflow;
-                    setTimeout(function () {
-                        if (overlay && overlay.parentNode) {
-                            overlay.parentNode.removeChild(overlay);
-                        }
-                        overlay = null;
-                    }, 180);
-                    if (keyHandler) {
-                        parentWindow.removeEventListener("keydown", keyHandler);
-                        keyHandler = null;
-                    }
-                }
+@st.cache_data(ttl=3600, max_entries=MAX_HISTORY_ENTRIES, show_spinner=False)
+def download_gcs_image(gcs_uri: str) -> Optional[bytes]:
+    bucket = get_gcs_bucket()
+    if bucket is None:
+        return None
+    return bucket.blob(gcs_uri.split("/", 3)[3]).download_as_bytes()
 
-                function show(src) {
-                    hide();
-                    overlay = doc.createElement("div");
-                    overlay.id = "streamlit-lightbox-overlay";
-                    overlay.style.position = "fixed";
-                    overlay.style.zIndex = "10000";
-                    overlay.style.top = "0";
-                    overlay.style.left = "0";
-                    overlay.style.right = "0";
-                    overlay.style.bottom = "0";
-                    overlay.style.display = "flex";
-                    overlay.style.justifyContent = "center";
-                    overlay.style.alignItems = "center";
-                    overlay.style.background = "rgba(0, 0, 0, 0.92)";
-                    overlay.style.cursor = "zoom-out";
-                    overlay.style.opacity = "0";
-                    overlay.style.transition = "opacity 0.18s ease-in-out";
-                    overlay.setAttribute("data-original-overflow", doc.body.style.overflow || "");
-                    doc.body.style.overflow = "hidden";
-
-                    const full = doc.createElement("img");
-                    full.src = src;
-                    full.alt = "Generated image fullscreen";
-                    full.style.maxWidth = "100vw";
-                    full.style.maxHeight = "100vh";
-                    full.style.objectFit = "contain";
-                    full.style.boxShadow = "0 20px 45px rgba(0, 0, 0, 0.5)";
-                    full.style.borderRadius = "0";
-
-                    overlay.appendChild(full);
-                    overlay.addEventListener("click", hide);
-
-                    keyHandler = function (event) {
-                        if (event.key === "Escape") {
-                            hide();
-                        }
-                    };
-                    parentWindow.addEventListener("keydown", keyHandler);
-
-                    doc.body.appendChild(overlay);
-                    requestAnimationFrame(function () {
-                        overlay.style.opacity = "1";
-                    });
-                }
 
-                return { show, hide };
-            })();
-        })();
-        </script>
-        """,
-        height=0,
-        scrolling=False,
-    )
+def release_uploaded_image(entry: Dict[str, object]) -> None:
+    # Once the GCS copy exists the entry keeps only its thumbnail and URI; the full image is fetched on demand.
+    if not isinstance(entry.get("thumbnail"), bytes) or "image_bytes" not in entry:
+        return
+    upload_result = _upload_result(entry)
+    if upload_result is None:
+        return
+    entry["gcs_uri"] = upload_result[0]
+    del entry["image_bytes"]
 
 
-def render_clickable_image(image_bytes: bytes, element_id: str, mime_type: str = "image/png") -> None:
-    ensure_lightbox_assets()
-    encoded = base64.b64encode(image_bytes).decode("utf-8")
-    image_src = f"data:{mime_type};base64,{encoded}"
-    image_src_json = json.dumps(image_src)
-    components.html(
-        f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="utf-8">
-    <style>
-        body {{
-            margin: 0;
-            padding: 0;
-            background: transparent;
-        }}
-        img {{
-            width: 100%;
-            display: block;
+def add_history_entries(entries: List[Dict[str, object]]) -> None:
+    # The deque's maxlen drops the oldest entries, which bounds the bytes held per session.
+    st.session_state.history.extendleft(reversed(entries))
+
+
+LIGHTBOX_HTML = """
+<script>
+(function () {
+    const parentWindow = window.parent;
+    if (!parentWindow) {
+        return;
+    }
+
+    try {
+        delete parentWindow.__streamlitLightbox;
+    } catch (err) {
+        parentWindow.__streamlitLightbox = undefined;
+    }
+    parentWindow.__streamlitLightboxInitialized = false;
+    const doc = parentWindow.document;
+
+    if (!doc.getElementById("streamlit-lightbox-style")) {
+        const style = doc.createElement("style");
+        style.id = "streamlit-lightbox-style";
+        style.textContent = `
+        .st-key-history [data-testid="stImage"] img {
             border-radius: 12px;
+            box-shadow: 0 4px 14px rgba(0, 0, 0, 0.12);
+        }
+        .st-key-history [class*="st-key-full_"] [data-testid="stImage"] img {
             cursor: pointer;
             transition: transform 0.16s ease-in-out;
-            box-shadow: 0 4px 14px rgba(0, 0, 0, 0.12);
-        }}
-        img:hover {{
+        }
+        .st-key-history [class*="st-key-full_"] [data-testid="stImage"] img:hover {
             transform: scale(1.02);
-        }}
-    </style>
-</head>
-<body>
-    <img id="thumb" src="{image_src}" alt="Generated image">
-    <script>
-    (function() {{
-        const img = document.getElementById("thumb");
-        if (!img) {{
-            return;
-        }}
+        }
+        `;
+        doc.head.appendChild(style);
+    }
 
-        function resizeFrame() {{
-            const frame = window.frameElement;
-            if (!frame) {{
+    parentWindow.__streamlitLightbox = (function () {
+        let overlay = null;
+        let keyHandler = null;
+
+        function hide() {
+            if (!overlay) {
                 return;
-            }}
-            const frameWidth = frame.getBoundingClientRect().width || img.naturalWidth || img.clientWidth || 0;
-            const ratio = img.naturalWidth ? (img.naturalHeight / Math.max(img.naturalWidth, 1)) : (img.clientHeight / Math.max(img.clientWidth, 1) || 1);
-            const height = frameWidth ? Math.max(160, frameWidth * ratio) : (img.clientHeight || img.naturalHeight || 320);
-            frame.style.height = height + "px";
-        }}
-
-        if (img.complete) {{
-            resizeFrame();
-        }} else {{
-            img.addEventListener("load", resizeFrame);
-        }}
-        window.addEventListener("resize", resizeFrame);
-        setTimeout(resizeFrame, 60);
-
-        img.addEventListener("click", function() {{
-            if (window.parent && window.parent.__streamlitLightbox) {{
-                window.parent.__streamlitLightbox.show({image_src_json});
-            }}
-        }});
-    }})();
-    </script>
-</body>
-</html>
-""",
-        height=400,
-        scrolling=False,
-    )
+            }
+            overlay.style.opacity = "0";
+            const originalOverflow = overlay.getAttribute("data-original-overflow") || "";
+            doc.body.style.overflow = originalOverflow;
+            setTimeout(function () {
+                if (overlay && overlay.parentNode) {
+                    overlay.parentNode.removeChild(overlay);
+                }
+                overlay = null;
+            }, 180);
+            if (keyHandler) {
+                parentWindow.removeEventListener("keydown", keyHandler);
+                keyHandler = null;
+            }
+        }
+
+        function show(src) {
+            hide();
+            overlay = doc.createElement("div");
+            overlay.id = "streamlit-lightbox-overlay";
+            overlay.style.position = "fixed";
+            overlay.style.zIndex = "10000";
+            overlay.style.top = "0";
+            overlay.style.left = "0";
+            overlay.style.right = "0";
+            overlay.style.bottom = "0";
+            overlay.style.display = "flex";
+            overlay.style.justifyContent = "center";
+            overlay.style.alignItems = "center";
+            overlay.style.background = "rgba(0, 0, 0, 0.92)";
+            overlay.style.cursor = "zoom-out";
+            overlay.style.opacity = "0";
+            overlay.style.transition = "opacity 0.18s ease-in-out";
+            overlay.setAttribute("data-original-overflow", doc.body.style.overflow || "");
+            doc.body.style.overflow = "hidden";
+
+            const full = doc.createElement("img");
+            full.src = src;
+            full.alt = "Generated image fullscreen";
+            full.style.maxWidth = "100vw";
+            full.style.maxHeight = "100vh";
+            full.style.objectFit = "contain";
+            full.style.boxShadow = "0 20px 45px rgba(0, 0, 0, 0.5)";
+            full.style.borderRadius = "0";
+
+            overlay.appendChild(full);
+            overlay.addEventListener("click", hide);
+
+            keyHandler = function (event) {
+                if (event.key === "Escape") {
+                    hide();
+                }
+            };
+            parentWindow.addEventListener("keydown", keyHandler);
+
+            doc.body.appendChild(overlay);
+            requestAnimationFrame(function () {
+                overlay.style.opacity = "1";
+            });
+        }
+
+        return { show, hide };
+    })();
+
+    // One delegated handler covers every full-resolution history image, including ones added on
+    // later reruns. Thumbnails are excluded so the fullscreen view never upscales a 512 px preview.
+    if (parentWindow.__streamlitLightboxClick) {
+        doc.removeEventListener("click", parentWindow.__streamlitLightboxClick, true);
+    }
+    parentWindow.__streamlitLightboxClick = function (event) {
+        const target = event.target;
+        if (!target || target.tagName !== "IMG" || !target.closest(".st-key-history [class*='st-key-full_'] [data-testid='stImage']")) {
+            return;
+        }
+        parentWindow.__streamlitLightbox.show(target.currentSrc || target.src);
+    };
+    doc.addEventListener("click", parentWindow.__streamlitLightboxClick, true);
+})();
+</script>
+"""
+
 
+def ensure_lightbox_assets() -> None:
+    # Rendered on every history render: the click handler lives in this iframe, so it must stay mounted.
+    components.html(LIGHTBOX_HTML, height=0, scrolling=False)
+
+
+def _finished_upload_status(entry: Dict[str, object], upload_future: Future) -> None:
+    if upload_future.exception() is not None:
+        st.caption(f"GCS: failed ({upload_future.exception()})")
+    else:
+        signed_url = get_signed_url(entry)
+        st.caption(f"[GCS: uploaded]({signed_url})" if signed_url else "GCS: uploaded")
 
+
+@st.fragment(run_every=UPLOAD_STATUS_REFRESH_SECONDS)
+def _pending_upload_status(entry: Dict[str, object], upload_future: Future) -> None:
+    # Drawn in place: an app rerun would clear the messages and grid of the batch that was just submitted.
+    if upload_future.done():
+        _finished_upload_status(entry, upload_future)
+    else:
+        st.caption("GCS: uploading")
+
+
+def render_upload_status(entry: Dict[str, object]) -> None:
+    upload_future = entry.get("upload_future")
+    if not isinstance(upload_future, Future):
+        return
+    if upload_future.done():
+        _finished_upload_status(entry, upload_future)
+    else:
+        _pending_upload_status(entry, upload_future)
+
+
+@st.fragment
 def render_history() -> None:
     if not st.session_state.history:
         return
 
     st.subheader("履歴")
-    for entry in st.session_state.history:
-        image_bytes = entry.get("image_bytes")
-        prompt_text = entry.get("prompt") or ""
-        mime_type = entry.get("mime_type") or "image/png"
-        extension = (entry.get("extension") or "png").lstrip(".") or "png"
-        if image_bytes:
+    ensure_lightbox_assets()
+    with st.container(key="history"):
+        for entry in st.session_state.history:
+            release_uploaded_image(entry)
+            image_bytes = entry.get("image_bytes")
+            gcs_uri = entry.get("gcs_uri")
+            thumbnail = entry.get("thumbnail")
+            prompt_text = entry.get("prompt") or ""
+            mime_type = entry.get("mime_type") or "image/png"
+            extension = (entry.get("extension") or "png").lstrip(".") or "png"
             image_id = entry.get("id")
             if not isinstance(image_id, str):
-                image_id = f"img_{uuid.uuid4().hex}"
+                image_id = f"img_{secrets.token_hex(8)}"
                 entry["id"] = image_id
-            render_clickable_image(image_bytes, image_id, mime_type=mime_type)
-            st.markdown("<div style='height:15px;'></div>", unsafe_allow_html=True)
-        prompt_display = prompt_text.strip()
-        prompt_block = (
-            f'<div style="margin-top:15px; font-weight:600;">Prompt</div>'
-            f'<div style="white-space:pre-wrap; background:rgba(0,0,0,0.02); '
-            f'padding:10px; border-radius:8px; margin-top:6px;">'
-            f'{html.escape(prompt_display) if prompt_display else "(未入力)"}'
-            f"</div>"
-        )
-        st.markdown(prompt_block, unsafe_allow_html=True)
-        meta_bits: List[str] = []
-        aspect_ratio = entry.get("aspect_ratio")
-        if aspect_ratio:
-            meta_bits.append(f"Aspect: {aspect_ratio}")
-        resolution = entry.get("resolution")
-        if resolution:
-            meta_bits.append(f"Resolution: {resolution}")
-        model_name = entry.get("model")
-        if model_name:
-            meta_bits.append(f"Model: {model_name}")
-        if entry.get("reference_used"):
-            meta_bits.append("Ref: yes")
-        if meta_bits:
-            st.caption(" / ".join(meta_bits))
-
-        download_filename = (
-            f"{sanitize_filename_component(prompt_display or 'prompt')}_{image_id}.{extension}"
-        )
-        st.download_button(
-            "Download",
-            data=image_bytes or b"",
-            file_name=download_filename,
-            mime=mime_type,
-            key=f"download_{image_id}",
-        )
-        st.divider()
+            if isinstance(thumbnail, bytes):
+                # Full resolution is only sent to the browser when explicitly requested.
+                st.image(thumbnail)
+                if st.toggle("View full", key=f"view_full_{image_id}"):
+                    full_image = image_bytes
+                    if not isinstance(full_image, bytes) and isinstance(gcs_uri, str):
+                        try:
+                            full_image = download_gcs_image(gcs_uri)
+                        except Exception as exc:  # noqa: BLE001
+                            st.error(f"GCSからの画像取得に失敗しました: {exc}")
+                    if isinstance(full_image, bytes) and full_image:
+                        # Only full-resolution images open in the lightbox (see LIGHTBOX_HTML).
+                        with st.container(key=f"full_{image_id}"):
+                            st.image(full_image, use_container_width=True)
+                st.markdown("<div style='height:15px;'></div>", unsafe_allow_html=True)
+            elif isinstance(image_bytes, bytes) and image_bytes:
+                with st.container(key=f"full_{image_id}"):
+                    st.image(image_bytes)
+                st.markdown("<div style='height:15px;'></div>", unsafe_allow_html=True)
+            prompt_display = prompt_text.strip()
+            prompt_block = (
+                f'<div style="margin-top:15px; font-weight:600;">Prompt</div>'
+                f'<div style="white-space:pre-wrap; background:rgba(0,0,0,0.02); '
+                f'padding:10px; border-radius:8px; margin-top:6px;">'
+                f'{html.escape(prompt_display) if prompt_display else "(未入力)"}'
+                f"</div>"
+            )
+            st.markdown(prompt_block, unsafe_allow_html=True)
+            meta_bits: List[str] = []
+            aspect_ratio = entry.get("aspect_ratio")
+            if aspect_ratio:
+                meta_bits.append(f"Aspect: {aspect_ratio}")
+            resolution = entry.get("resolution")
+            if resolution:
+                meta_bits.append(f"Resolution: {resolution}")
+            model_name = entry.get("model")
+            if model_name:
+                meta_bits.append(f"Model: {model_name}")
+            if entry.get("reference_used"):
+                meta_bits.append("Ref: yes")
+            if entry.get("from_cache"):
+                meta_bits.append("Cached")
+            if meta_bits:
+                st.caption(" / ".join(meta_bits))
+            render_upload_status(entry)
+
+            download_filename = (
+                f"{sanitize_filename_component(prompt_display or 'prompt')}_{image_id}.{extension}"
+            )
+            if isinstance(image_bytes, bytes):
+                st.download_button(
+                    "Download",
+                    data=image_bytes,
+                    file_name=download_filename,
+                    mime=mime_type,
+                    key=f"download_{image_id}",
+                    on_click="ignore",
+                )
+            else:
+                signed_url = get_signed_url(entry)
+                if signed_url:
+                    st.link_button("Download", signed_url)
+            st.divider()
+
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key: str) -> genai.Client:
+    http_options = types.HttpOptions(
+        timeout=GENERATION_TIMEOUT_MS,
+        async_client_args={"limits": GENERATION_HTTP_LIMITS, "http2": GENERATION_HTTP2},
+    )
+    return genai.Client(api_key=api_key, http_options=http_options)
 
 
-def main() -> None:
-    st.set_page_config(page_title=TITLE, page_icon="🧠", layout="centered")
-    init_history()
-    require_login()
+@st.cache_resource(show_spinner=False)
+def _generation_event_loop() -> asyncio.AbstractEventLoop:
+    # The cached client's async connection pool is bound to the loop it first ran on,
+    # so every generation is scheduled on one long-lived loop instead of asyncio.run().
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="gemini-generation-loop", daemon=True).start()
+    return loop
 
-    st.title("FreedomStandard")
 
-    api_key = load_configured_api_key()
+@st.cache_resource(show_spinner=False)
+def _generation_semaphore() -> asyncio.Semaphore:
+    return asyncio.Semaphore(GENERATION_CONCURRENCY)
+
+
+def _is_transient_error(exc: BaseException) -> bool:
+    if isinstance(exc, TRANSIENT_ERRORS):
+        return True
+    if not isinstance(exc, genai_errors.APIError) or exc.code not in TRANSIENT_API_STATUS_CODES:
+        return False
+    # A zero quota (e.g. the model is not available on the free tier) will not clear by waiting.
+    return "limit: 0" not in (exc.message or "")
+
 
-    prompt = st.text_area("Prompt", height=150, placeholder="描いてほしい内容を入力してください")
-    uploaded_refs = st.file_uploader(
-        "Reference images (任意・複数可)",
-        type=["png", "jpg", "jpeg", "webp"],
-        accept_multiple_files=True,
+def _retry_after_seconds(exc: BaseException) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if headers is not None:
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    details = getattr(exc, "details", None)
+    error = details.get("error", details) if isinstance(details, dict) else {}
+    for detail in error.get("details") or ():
+        if isinstance(detail, dict) and str(detail.get("@type", "")).endswith("RetryInfo"):
+            try:
+                return float(str(detail.get("retryDelay", "")).rstrip("s"))
+            except ValueError:
+                return None
+    return None
+
+
+def _retry_delay_seconds(exc: BaseException, attempt: int) -> float:
+    delay = _retry_after_seconds(exc)
+    if delay is None:
+        delay = 2 ** (attempt - 1)
+    return min(GENERATION_BACKOFF_CAP_SECONDS, delay) + random.uniform(0, 0.5)
+
+
+async def _stream_first_image(
+    client: genai.Client,
+    contents: object,
+    image_config_kwargs: Dict[str, object],
+) -> Optional[bytes]:
+    stream = await client.aio.models.generate_content_stream(
+        model=MODEL_NAME,
+        contents=contents,
+        config=types.GenerateContentConfig(
+            response_modalities=["IMAGE"],
+            image_config=types.ImageConfig(**image_config_kwargs),
+        ),
     )
-    ref_files = _load_uploaded_files(uploaded_refs)
-    aspect_ratio = st.radio(
-        "アスペクト比",
-        IMAGE_ASPECT_RATIO_OPTIONS,
-        index=IMAGE_ASPECT_RATIO_OPTIONS.index(IMAGE_ASPECT_RATIO),
-        horizontal=True,
+    try:
+        # Return as soon as the image part arrives instead of waiting for the trailing chunks.
+        async for chunk in stream:
+            image_bytes = extract_inline_image_bytes(chunk) or collect_image_bytes(chunk)
+            if image_bytes:
+                return image_bytes
+    finally:
+        close_stream = getattr(stream, "aclose", None)
+        if callable(close_stream):
+            await close_stream()
+    return None
+
+
+async def _generate_one(
+    client: genai.Client,
+    semaphore: asyncio.Semaphore,
+    contents: object,
+    image_config_kwargs: Dict[str, object],
+) -> Optional[bytes]:
+    attempt = 0
+    while True:
+        try:
+            async with semaphore:
+                return await _stream_first_image(client, contents, image_config_kwargs)
+        except Exception as exc:  # noqa: BLE001
+            attempt += 1
+            if attempt >= GENERATION_MAX_ATTEMPTS or not _is_transient_error(exc):
+                raise
+            delay = _retry_delay_seconds(exc, attempt)
+        # Back off outside the semaphore so waiting retries do not hold a slot.
+        await asyncio.sleep(delay)
+
+
+def run_generations(
+    client: genai.Client,
+    contents: object,
+    image_config_kwargs: Dict[str, object],
+    count: int = 1,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    on_result: Optional[Callable[[int, object], None]] = None,
+) -> List[object]:
+    loop = _generation_event_loop()
+    semaphore = _generation_semaphore()
+    futures = [
+        asyncio.run_coroutine_threadsafe(_generate_one(client, semaphore, contents, image_config_kwargs), loop)
+        for _ in range(max(1, count))
+    ]
+    positions = {future: position for position, future in enumerate(futures)}
+    for completed, future in enumerate(as_completed(futures), start=1):
+        if on_result is not None:
+            on_result(positions[future], future.exception() or future.result())
+        if on_progress is not None:
+            on_progress(completed, len(futures))
+    # Keep per-request failures as values so a single 429 does not discard the whole batch.
+    return [future.exception() or future.result() for future in futures]
+
+
+@st.cache_resource(show_spinner=False)
+def _generation_cache() -> Tuple[TTLCache, threading.Lock]:
+    return TTLCache(maxsize=GENERATION_CACHE_MAX_ENTRIES, ttl=GENERATION_CACHE_TTL_SECONDS), threading.Lock()
+
+
+def reference_digests(ref_files: Sequence[Tuple[bytes, Optional[str], str]]) -> Tuple[Tuple[str, str], ...]:
+    return tuple((mime or "", digest) for _, mime, digest in ref_files)
+
+
+def generation_cache_key(
+    prompt_text: str,
+    aspect_ratio: str,
+    resolution: str,
+    ref_digests: Tuple[Tuple[str, str], ...],
+    variant_index: int,
+) -> Tuple[object, ...]:
+    # Whitespace-only edits (re-wrapped lines, trailing spaces) hit the same entry.
+    normalized_prompt = " ".join(prompt_text.split())
+    return (MODEL_NAME, normalized_prompt, aspect_ratio, resolution, ref_digests, variant_index)
+
+
+def lookup_cached_generation(key: Tuple[object, ...]) -> Optional[bytes]:
+    cache, lock = _generation_cache()
+    with lock:
+        return cache.get(key)
+
+
+def store_cached_generation(key: Tuple[object, ...], image_bytes: bytes) -> None:
+    cache, lock = _generation_cache()
+    with lock:
+        cache[key] = image_bytes
+
+
+@st.cache_resource(show_spinner=False)
+def _reference_uploads() -> Tuple[TTLCache, threading.Lock]:
+    # Futures of Files API URIs keyed by (api_key, digest); entries expire before the files do.
+    return TTLCache(maxsize=REFERENCE_UPLOAD_MAX_ENTRIES, ttl=REFERENCE_FILE_URI_TTL_SECONDS), threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def _reference_upload_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=REFERENCE_UPLOAD_MAX_WORKERS, thread_name_prefix="reference-upload")
+
+
+def _upload_reference_file(client: genai.Client, data: bytes, mime_type: str) -> str:
+    uploaded = client.files.upload(file=io.BytesIO(data), config=types.UploadFileConfig(mime_type=mime_type))
+    return str(uploaded.uri)
+
+
+def reference_file_upload(api_key: str, data: bytes, mime_type: str, digest: str) -> "Future[str]":
+    uploads, lock = _reference_uploads()
+    key = (api_key, digest)
+    with lock:
+        upload = uploads.get(key)
+        if upload is None or (upload.done() and upload.exception() is not None):
+            upload = _reference_upload_executor().submit(
+                _upload_reference_file, get_genai_client(api_key), data, mime_type
+            )
+            uploads[key] = upload
+    return upload
+
+
+def build_reference_part(api_key: str, data: bytes, mime_type: str, digest: str) -> types.Part:
+    # The first use starts a background upload and goes inline; once the upload has finished,
+    # later requests with the same reference send only its Files API URI.
+    upload = reference_file_upload(api_key, data, mime_type, digest)
+    if len(data) > INLINE_REFERENCE_LIMIT_BYTES:
+        # Too large to inline (only references Pillow could not downscale), so wait for the URI.
+        try:
+            upload.result()
+        except Exception:  # noqa: BLE001
+            pass
+    if upload.done() and upload.exception() is None:
+        return types.Part(file_data=types.FileData(file_uri=upload.result(), mime_type=mime_type))
+    return types.Part(inline_data=types.Blob(data=data, mime_type=mime_type))
+
+
+def _is_media_resolution_error(result: object) -> bool:
+    is_invalid_argument = isinstance(result, google_exceptions.InvalidArgument) or (
+        isinstance(result, genai_errors.ClientError) and result.code == 400
     )
-    resolution_label = st.radio(
-        "解像度",
-        ("1K", "2K", "4K"),
-        index=0,
-        horizontal=True,
+    return is_invalid_argument and "Media resolution is not enabled for this model" in str(result)
+
+
+def report_generation_error(exc: BaseException) -> None:
+    quota_exhausted = isinstance(exc, google_exceptions.ResourceExhausted) or (
+        isinstance(exc, genai_errors.APIError) and exc.code == 429
     )
-    if st.button("Generate", type="primary"):
-        if not api_key:
-            st.warning("Gemini API key が設定されていません。Streamlit secrets などで設定してください。")
-            st.stop()
-        if not prompt.strip():
-            st.warning("プロンプトを入力してください。")
-            st.stop()
+    if quota_exhausted:
+        st.error(
+            "Gemini API のクォータ（無料枠または請求プラン）を超えました。"
+            "しばらく待つか、Google AI Studio で利用状況と請求設定を確認してください。"
+        )
+        st.info("https://ai.google.dev/gemini-api/docs/rate-limits")
+    elif isinstance(exc, (google_exceptions.GoogleAPICallError, genai_errors.APIError)):
+        # The message and status are None when the error body is empty; str(exc) would then show "None. {}".
+        detail = exc.message or getattr(exc, "status", None) or f"HTTP {exc.code}"
+        st.error(f"API 呼び出しに失敗しました: {detail}")
+    elif isinstance(exc, httpx.TransportError):
+        st.error(f"Gemini API との通信に失敗しました: {exc}")
+    else:
+        # Anything else is a bug, not an API failure; keep the traceback visible.
+        LOGGER.error("Unexpected error during image generation", exc_info=exc)
+        st.exception(exc)
+
+
+def run_generation_request(
+    api_key: str,
+    prompt: str,
+    uploaded_refs: Optional[object],
+    aspect_ratio: str,
+    resolution_label: str,
+    variant_count: int,
+) -> None:
+    if not api_key:
+        st.warning("Gemini API key が設定されていません。Streamlit secrets などで設定してください。")
+        return
+    if not prompt.strip():
+        st.warning("プロンプトを入力してください。")
+        return
 
-        client = genai.Client(api_key=api_key.strip())
-        stripped_prompt = prompt.rstrip()
-        prompt_components: List[str] = []
-        if stripped_prompt:
-            prompt_components.append(stripped_prompt)
-        prompt_components.extend([DEFAULT_PROMPT_SUFFIX, NO_TEXT_TOGGLE_SUFFIX])
-        prompt_for_request = "\n".join(prompt_components)
-
-        contents_for_request: object
-        if ref_files:
-            # Use explicit constructors for compatibility across SDK versions.
+    ref_files = prepare_uploaded_references(uploaded_refs)
+    client = get_genai_client(api_key.strip())
+    # The prompt is non-empty here, so the tail always follows it on a new line.
+    prompt_for_request = prompt.rstrip() + PROMPT_TAIL
+
+    ref_digests = reference_digests(ref_files)
+    image_config_kwargs: Dict[str, object] = {"aspect_ratio": aspect_ratio}
+    if IMAGE_SIZE_CONFIG_KEY:
+        image_config_kwargs[IMAGE_SIZE_CONFIG_KEY] = resolution_label
+
+    cache_keys = [
+        generation_cache_key(prompt_for_request, aspect_ratio, resolution_label, ref_digests, index)
+        for index in range(variant_count)
+    ]
+    outcomes: List[object] = [lookup_cached_generation(key) for key in cache_keys]
+    pending = [index for index, outcome in enumerate(outcomes) if outcome is None]
+    user_prompt = prompt.strip()
+    upload_futures: Dict[int, Optional[Future]] = {}
+    # Checked once per batch so a disabled or misconfigured bucket is reported once, not per variant.
+    gcs_enabled = is_gcs_upload_enabled()
+    uploads_enabled = gcs_enabled
+
+    def start_upload(index: int, result: object) -> None:
+        nonlocal uploads_enabled
+        # Uploads start as each variant lands instead of after the whole batch.
+        if not uploads_enabled or not isinstance(result, bytes) or not result:
+            return
+        # Stored as WebP; the re-encode happens on the upload worker, off the script thread.
+        upload_futures[index] = upload_image_to_gcs(
+            result,
+            object_name=build_prompt_based_filename(user_prompt, extension="webp"),
+            mime_type="image/webp",
+            extension="webp",
+        )
+        if upload_futures[index] is None:
+            uploads_enabled = False
+
+    if pending:
+        with st.spinner("画像を生成しています..."):
+            # Built only when something has to be generated, so a fully cached resubmit
+            # never touches the Files API. Explicit constructors keep this portable across
+            # SDK versions and spare the SDK its own str/dict -> Content conversion.
             image_parts = [
-                types.Part(inline_data=types.Blob(data=img_bytes, mime_type=mime or "image/png"))
-                for img_bytes, mime in ref_files
+                build_reference_part(api_key.strip(), img_bytes, mime or "image/png", digest)
+                for img_bytes, mime, digest in ref_files
             ]
             text_part = types.Part(text=prompt_for_request)
             contents_for_request = [types.Content(role="user", parts=[*image_parts, text_part])]
-        else:
-            contents_for_request = prompt_for_request
-
-        image_config_kwargs: Dict[str, object] = {"aspect_ratio": aspect_ratio}
-        image_size_key = None
-        if hasattr(types.ImageConfig, "model_fields"):
-            if "image_size" in getattr(types.ImageConfig, "model_fields", {}):
-                image_size_key = "image_size"
-        elif hasattr(types.ImageConfig, "__fields__"):
-            if "image_size" in getattr(types.ImageConfig, "__fields__", {}):
-                image_size_key = "image_size"
-        if image_size_key:
-            image_config_kwargs[image_size_key] = resolution_label
-
-        def run_generation(include_size: bool) -> object:
-            cfg_kwargs = dict(image_config_kwargs)
-            if not include_size and image_size_key:
-                cfg_kwargs.pop(image_size_key, None)
-            return client.models.generate_content(
-                model=MODEL_NAME,
-                contents=contents_for_request,
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"],
-                    image_config=types.ImageConfig(**cfg_kwargs),
-                ),
+            progress_bar = st.progress(0.0)
+            results = run_generations(
+                client,
+                contents_for_request,
+                image_config_kwargs,
+                count=len(pending),
+                on_progress=lambda done, total: progress_bar.progress(done / total, text=f"{done}/{total}"),
+                on_result=lambda position, result: start_upload(pending[position], result),
             )
-
-        with st.spinner("画像を生成しています..."):
-            try:
-                response = run_generation(include_size=True)
-            except google_exceptions.InvalidArgument as exc:
-                if "Media resolution is not enabled for this model" in str(exc) and image_size_key:
-                    st.info("このモデルでは解像度指定が無効でした。デフォルト解像度で再試行します。")
-                    try:
-                        response = run_generation(include_size=False)
-                    except Exception:
-                        raise exc
-                else:
-                    raise
-            except google_exceptions.ResourceExhausted:
-                st.error(
-                    "Gemini API のクォータ（無料枠または請求プラン）を超えました。"
-                    "しばらく待つか、Google AI Studio で利用状況と請求設定を確認してください。"
+            progress_bar.empty()
+            retry_indexes = [index for index, result in enumerate(results) if _is_media_resolution_error(result)]
+            if retry_indexes and IMAGE_SIZE_CONFIG_KEY:
+                st.info("このモデルでは解像度指定が無効でした。デフォルト解像度で再試行します。")
+                fallback_kwargs = dict(image_config_kwargs)
+                fallback_kwargs.pop(IMAGE_SIZE_CONFIG_KEY, None)
+                retried = run_generations(
+                    client,
+                    contents_for_request,
+                    fallback_kwargs,
+                    count=len(retry_indexes),
+                    on_result=lambda position, result: start_upload(pending[retry_indexes[position]], result),
                 )
-                st.info("https://ai.google.dev/gemini-api/docs/rate-limits")
-                st.stop()
-            except google_exceptions.GoogleAPICallError as exc:
-                st.error(f"API 呼び出しに失敗しました: {exc.message}")
-                st.stop()
-            except Exception as exc:  # noqa: BLE001
-                st.error(f"予期しないエラーが発生しました: {exc}")
-                st.stop()
-
-        image_bytes = collect_image_bytes(response)
-        if not image_bytes:
-            st.error("画像データを取得できませんでした。")
-            st.stop()
+                for index, result in zip(retry_indexes, retried):
+                    results[index] = result
+
+        for index, result in zip(pending, results):
+            outcomes[index] = result
+            if isinstance(result, bytes) and result:
+                store_cached_generation(cache_keys[index], result)
+
+    new_entries: List[Dict[str, object]] = []
+    new_images: List[bytes] = []
+    reported_errors: set = set()
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, BaseException):
+            # Variants usually fail for the same reason (e.g. a 429); show each distinct error once.
+            error_key = (type(outcome), str(outcome))
+            if error_key not in reported_errors:
+                reported_errors.add(error_key)
+                report_generation_error(outcome)
+            continue
+        image_bytes = outcome
+        if not isinstance(image_bytes, bytes) or not image_bytes:
+            missing_image_message = "画像データを取得できませんでした。"
+            if missing_image_message not in reported_errors:
+                reported_errors.add(missing_image_message)
+                st.error(missing_image_message)
+            continue
 
+        from_cache = index not in pending
         image_extension, image_mime_type = detect_image_format(image_bytes)
-        user_prompt = prompt.strip()
-        object_name = build_prompt_based_filename(user_prompt, extension=image_extension)
-        upload_image_to_gcs(
-            image_bytes,
-            object_name=object_name,
-            mime_type=image_mime_type,
-            extension=image_extension,
-        )
-
-        st.session_state.history.insert(
-            0,
+        new_images.append(image_bytes)
+        new_entries.append(
             {
-                "id": f"img_{uuid.uuid4().hex}",
+                "id": f"img_{secrets.token_hex(8)}",
                 "image_bytes": image_bytes,
+                "thumbnail": make_history_thumbnail(image_bytes),
                 "prompt": user_prompt,
                 "model": MODEL_NAME,
                 "no_text": True,
@@ -933,12 +1409,64 @@ def main() -> None:
                 "reference_used": bool(ref_files),
                 "mime_type": image_mime_type,
                 "extension": image_extension,
-            },
+                "from_cache": from_cache,
+                "upload_future": upload_futures.get(index),
+            }
         )
-        st.success("生成完了")
 
+    if not new_entries:
+        return
+
+    add_history_entries(new_entries)
+    if not gcs_enabled and any(not entry["from_cache"] for entry in new_entries):
+        st.info("GCS へのアップロードは無効化されています。")
+    if len(new_images) > 1:
+        for column, image_bytes in zip(st.columns(len(new_images)), new_images):
+            column.image(image_bytes, use_container_width=True)
+    st.success("生成完了")
+
+
+@st.fragment
+def generation_panel(api_key: str) -> None:
+    # Inputs only submit on Generate, so editing them does not rerun the script per keystroke.
+    with st.form("generation_form"):
+        prompt = st.text_area("Prompt", height=150, placeholder="描いてほしい内容を入力してください")
+        uploaded_refs = st.file_uploader(
+            "Reference images (任意・複数可)",
+            type=["png", "jpg", "jpeg", "webp"],
+            accept_multiple_files=True,
+        )
+        aspect_ratio = st.radio(
+            "アスペクト比",
+            IMAGE_ASPECT_RATIO_OPTIONS,
+            index=IMAGE_ASPECT_RATIO_OPTIONS.index(IMAGE_ASPECT_RATIO),
+            horizontal=True,
+        )
+        resolution_label = st.radio(
+            "解像度",
+            IMAGE_RESOLUTION_OPTIONS,
+            index=0,
+            horizontal=True,
+        )
+        variant_count = st.number_input("Variants", min_value=1, max_value=MAX_VARIANTS, value=1, step=1)
+        submitted = st.form_submit_button("Generate", type="primary")
+
+    if submitted:
+        run_generation_request(api_key, prompt, uploaded_refs, aspect_ratio, resolution_label, int(variant_count))
+
+    # Nested here so a submit refreshes the history without a full app rerun.
     render_history()
 
 
+def main() -> None:
+    st.set_page_config(page_title=TITLE, page_icon="🧠", layout="centered")
+    init_history()
+    require_login()
+
+    st.title("FreedomStandard")
+
+    generation_panel(load_configured_api_key())
+
+
 if __name__ == "__main__":
     main()